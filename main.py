@@ -1,6 +1,9 @@
 import pygame
+import array
 import math
+import operator
 import random
+import re
 
 # ---------------------------
 # Pygame Initialization
@@ -21,11 +24,25 @@ font = pygame.font.SysFont("monospace", 20)
 # Global Interpreter State
 # ---------------------------
 # 'cursor' obj represents the drawing position, direction, and current drawing color.
-cursor = {"x": WIDTH // 2, "y": HEIGHT // 2, "angle": 0, "color": (255, 255, 255)}
-# 'symbols' stores variables and function definitions.
-symbols = {}
-# 'call_stack' is for saving/restoring state during function calls.
-call_stack = []
+# 'cos' and 'sin' cache the unit direction vector for 'angle' and are refreshed on every turn.
+cursor = {"x": WIDTH // 2, "y": HEIGHT // 2, "angle": 0, "cos": 1.0, "sin": 0.0, "color": (255, 255, 255)}
+# 'stroke' collects connected line segments of one color so they can be drawn in a single call.
+# A stroke is drawn and restarted from its last point once it holds STROKE_LIMIT points.
+stroke = {"color": None, "points": []}
+STROKE_LIMIT = 1024
+# 'memo_cache' maps the entry state of a function call to a record of the drawing it produced.
+# 'memo_size' counts the operations held across all records (plus one per record).
+memo_cache = {}
+memo_size = {"ops": 0}
+# Recordings are abandoned once they pass MEMO_RECORD_LIMIT operations, and the cache is emptied
+# once it would hold more than MEMO_LIMIT operations in total.
+MEMO_RECORD_LIMIT = 5000
+MEMO_LIMIT = 100000
+# 'recordings' holds the record of the memoizable call that is currently executing, if any.
+recordings = []
+# 'scopes' is the chain of active frames as (name_to_slot, slot_values) pairs:
+# the program's globals first, then one frame per function call.
+scopes = []
 
 # ---------------------------
 # Color Definitions
@@ -36,6 +53,10 @@ COLORS = {
     "Green": (0, 255, 0),
     "Black": (0, 0, 0)
 }
+# Choices for COLOR Random, built once instead of on every use.
+COLOR_VALUES = tuple(COLORS.values())
+# Used for unknown color names.
+DEFAULT_COLOR = (255, 255, 255)
 
 # ---------------------------
 # Reserved Keywords for the Language
@@ -91,219 +112,248 @@ DRAW Star 15 AT 400 , 300
 # ---------------------------
 # Tokenizer: Convert code string into tokens
 # ---------------------------
+# One pass over the source: "!=", single punctuation/operator characters, or any other run of
+# non-space characters (numbers, names and keywords).
+TOKEN_PATTERN = re.compile(r"!=|[-+*/=<>!(){},]|[^\s\-+*/=<>!(){},]+")
+
+
 def tokenize(code):
-    # Insert spaces around block symbols and punctuation so they become separate tokens.
-    for ch in ["{", "}", "(", ")", ","]:
-        code = code.replace(ch, f" {ch} ")
-    # Ensure that operators are separated by spaces.
-    for op in ["+", "-", "*", "/", "=", ">", "<", "!"]:
-        code = code.replace(op, f" {op} ")
-    # Split code into tokens and filter out any empty strings.
-    tokens = [tok for tok in code.split() if tok]
-
-    # Combine tokens to handle multi-character operators like "!="
-    i = 0
-    combined = []
-    while i < len(tokens):
-        if tokens[i] == "!" and i + 1 < len(tokens) and tokens[i + 1] == "=":
-            combined.append("!=")
-            i += 2
-        else:
-            combined.append(tokens[i])
-            i += 1
-    return combined
+    return TOKEN_PATTERN.findall(code)
 
 
 # ---------------------------
-# Expression Parser: Recursive-Descent Parsing
+# Expression Parser: Shunting-Yard Parsing
 # ---------------------------
+# Expression nodes are tuples tagged with an integer kind:
+# (KIND_CONST, value), (KIND_VAR, name) and (KIND_BIN, op, left, right).
+KIND_CONST, KIND_VAR, KIND_BIN = range(3)
+
+# Binary operators and their binding strength; all are left-associative.
+PRECEDENCE = {"+": 1, "-": 1, "*": 2, "/": 2}
+
+
+def reduce_operator(ops, output):
+    # Pop one operator and combine the top two operands into a node.
+    op = ops.pop()
+    right = output.pop()
+    left = output.pop()
+    output.append((KIND_BIN, op, left, right))
+
+
 def parse_expression(tokens, i, stop_tokens=None):
     # Default to an empty set if no stop tokens are provided.
     if stop_tokens is None:
         stop_tokens = set()
-    # Parse a term first (handles multiplication/division)
-    node, i = parse_term(tokens, i, stop_tokens)
-    # Process addition and subtraction in a left-associative manner.
-    while i < len(tokens) and tokens[i] in ("+", "-") and tokens[i] not in stop_tokens:
-        op = tokens[i]
-        i += 1
-        right, i = parse_term(tokens, i, stop_tokens)
-        node = {"op": op, "left": node, "right": right}
-    return node, i
-
-
-def parse_term(tokens, i, stop_tokens):
-    # Parse a factor (handles basic numbers, variables, and parenthesized expressions)
-    node, i = parse_factor(tokens, i, stop_tokens)
-    # Process multiplication and division operators.
-    while i < len(tokens) and tokens[i] in ("*", "/") and tokens[i] not in stop_tokens:
-        op = tokens[i]
+    n = len(tokens)
+    output = []
+    ops = []
+    depth = 0
+    while True:
+        # Expect an operand: a number, a variable or an opening parenthesis.
+        if i >= n:
+            raise Exception("Unexpected end of tokens in expression")
+        token = tokens[i]
+        if token in stop_tokens or (depth and token == ")"):
+            raise Exception(f"Unexpected token '{token}' in expression")
         i += 1
-        right, i = parse_factor(tokens, i, stop_tokens)
-        node = {"op": op, "left": node, "right": right}
-    return node, i
-
-
-def parse_factor(tokens, i, stop_tokens):
-    # Check for unexpected end-of-tokens.
-    if i >= len(tokens):
-        raise Exception("Unexpected end of tokens in expression")
-    token = tokens[i]
-    if token in stop_tokens:
-        raise Exception(f"Unexpected token '{token}' in expression")
-    # Handle parenthesized expressions.
-    if token == "(":
-        node, i = parse_expression(tokens, i + 1, stop_tokens.union({")"}))
-        if i >= len(tokens) or tokens[i] != ")":
-            raise Exception("Expected )")
-        return node, i + 1
-    # Handle numbers (both integers and decimals).
-    elif token.replace('.', '', 1).isdigit():
-        return float(token), i + 1
-    # Treat remaining tokens as variables (even if they match a reserved keyword)
-    elif token.isalpha() or token in COMMAND_KEYWORDS:
-        return token, i + 1
-    else:
-        raise Exception("Unexpected token in expression: " + token)
-
-
-def parse_full_expression(token_list):
-    # Parse a complete expression from a list of tokens.
-    expr, i = parse_expression(token_list, 0)
-    if i != len(token_list):
-        raise Exception("Extra tokens in expression: " + " ".join(token_list[i:]))
-    return expr
+        if token == "(":
+            ops.append("(")
+            depth += 1
+            continue
+        # Handle numbers (both integers and decimals).
+        elif token.replace('.', '', 1).isdigit():
+            output.append((KIND_CONST, float(token)))
+        # Treat remaining tokens as variables (even if they match a reserved keyword)
+        elif token.isalpha() or token in COMMAND_KEYWORDS:
+            output.append((KIND_VAR, token))
+        else:
+            raise Exception("Unexpected token in expression: " + token)
+        # After an operand: close any parentheses, then look for an operator.
+        while True:
+            token = tokens[i] if i < n else None
+            if token in PRECEDENCE and token not in stop_tokens:
+                # Reduce operators that bind at least as tightly (left-associative).
+                while ops and ops[-1] != "(" and PRECEDENCE[ops[-1]] >= PRECEDENCE[token]:
+                    reduce_operator(ops, output)
+                ops.append(token)
+                i += 1
+                break
+            if not depth:
+                # End of the expression: reduce whatever is left.
+                while ops:
+                    reduce_operator(ops, output)
+                return output[0], i
+            if token != ")":
+                raise Exception("Expected )")
+            while ops[-1] != "(":
+                reduce_operator(ops, output)
+            ops.pop()
+            depth -= 1
+            i += 1
 
 
 def parse_expression_until(tokens, start, stop_tokens):
-    # Collect tokens until one of the stop tokens is encountered.
-    end = start
-    while end < len(tokens) and tokens[end] not in stop_tokens:
-        end += 1
-    expr = parse_full_expression(tokens[start:end])
+    # Parse an expression in place that must run right up to one of the stop tokens.
+    expr, end = parse_expression(tokens, start, stop_tokens)
+    if end < len(tokens) and tokens[end] not in stop_tokens:
+        raise Exception("Extra tokens in expression: " + tokens[end])
     return expr, end
 
 
 # ---------------------------
-# Expression Evaluators
+# Condition Parser: Parses binary conditions
 # ---------------------------
-def eval_expr(expr):
-    # Evaluate an arithmetic expression recursively.
-    if isinstance(expr, dict):
-        left = eval_expr(expr["left"])
-        right = eval_expr(expr["right"])
-        op = expr["op"]
-        if op == "+": return left + right
-        if op == "-": return left - right
-        if op == "*": return left * right
-        if op == "/": return left / right if right != 0 else 0
-    elif isinstance(expr, (int, float)):
-        return expr
-    elif isinstance(expr, str):
-        # Return the variable's value from the symbols dictionary; default to 0 if undefined.
-        return symbols.get(expr, 0)
-    else:
-        raise Exception("Cannot evaluate expression: " + str(expr))
-
-
-def eval_condition(cond):
-    # Evaluate a condition by comparing two evaluated expressions.
-    left = eval_expr(cond["left"])
-    right = eval_expr(cond["right"])
-    op = cond["op"]
-    if op == ">": return left > right
-    if op == "<": return left < right
-    if op == "=": return left == right
-    if op == "!=": return left != right
-    return False
+# Comparison operators are resolved to functions once, when the condition is parsed.
+COMPARISONS = {">": operator.gt, "<": operator.lt, "=": operator.eq, "!=": operator.ne}
 
 
-# ---------------------------
-# Condition Parser: Parses binary conditions
-# ---------------------------
 def parse_condition(tokens, i):
     # Parse the left-hand side expression for the condition.
-    left, i = parse_expression(tokens, i, stop_tokens={">", "<", "=", "!="})
+    left, i = parse_expression(tokens, i, stop_tokens=set(COMPARISONS))
     if i >= len(tokens):
         raise Exception("Expected operator in condition")
     op = tokens[i]
-    if op not in (">", "<", "=", "!="):
+    if op not in COMPARISONS:
         raise Exception("Expected comparison operator, got " + op)
     i += 1
     # Parse the right-hand side expression.
     right, i = parse_expression(tokens, i, stop_tokens={"{"})
-    return {"left": left, "op": op, "right": right}, i
+    return {"left": left, "fn": COMPARISONS[op], "right": right}, i
 
 
 # ---------------------------
-# Block End Finder: Matches opening and closing braces
+# Compiler: Lower Tokens into Bytecode
 # ---------------------------
-def find_block_end(tokens, start):
-    depth = 1  # Starting with one open brace
-    i = start
-    while i < len(tokens) and depth > 0:
-        if tokens[i] == "{":
-            depth += 1
-        elif tokens[i] == "}":
-            depth -= 1
-        i += 1
-    return i
+# Every instruction is a tuple whose first item is the opcode. Names, colors, compiled
+# expressions and function definitions are stored in the 'consts' pool and referenced by index.
+# Variables are resolved to slot indices in the frame of the program or function using them.
+consts = []
 
+SHAPE_OPCODES = {"Circle": "DRAW_CIRCLE", "Square": "DRAW_SQUARE", "Star": "DRAW_STAR"}
+MOVE_OPCODES = {"Forward": "MOVE_FWD", "Backward": "MOVE_BWD"}
+TURN_OPCODES = {"Right": "TURN_RIGHT", "Left": "TURN_LEFT"}
 
-# ---------------------------
-# Drawing Functions
-# ---------------------------
-def move_cursor(distance, direction):
-    # Save the current cursor position.
-    old_x, old_y = cursor["x"], cursor["y"]
-    angle_rad = math.radians(cursor["angle"])
-    # Update the cursor's position based on its current angle.
-    if direction == "Forward":
-        cursor["x"] += distance * math.cos(angle_rad)
-        cursor["y"] += distance * math.sin(angle_rad)
-    elif direction == "Backward":
-        cursor["x"] -= distance * math.cos(angle_rad)
-        cursor["y"] -= distance * math.sin(angle_rad)
-    # Draw a line from the old position to the new position.
-    pygame.draw.line(screen, cursor["color"], (old_x, old_y), (cursor["x"], cursor["y"]), 2)
 
+def divide(left, right):
+    # Division by zero yields 0 instead of raising.
+    return left / right if right != 0 else 0
 
-def draw_shape(shape, size, x=None, y=None):
-    # Determine the position to draw the shape. Use provided coordinates if available.
-    pos = (int(x) if x is not None else int(cursor["x"]),
-           int(y) if y is not None else int(cursor["y"]))
-    if shape == "Circle":
-        pygame.draw.circle(screen, cursor["color"], pos, int(size), 2)
-    elif shape == "Square":
-        pygame.draw.rect(screen, cursor["color"],
-                         (pos[0] - int(size) // 2, pos[1] - int(size) // 2, int(size), int(size)), 2)
-    elif shape == "Star":
-        # Calculate star points for a 5-point star
-        points = []
-        for i in range(5):
-            angle = i * 4 * math.pi / 5
-            points.append((pos[0] + size * math.cos(angle), pos[1] + size * math.sin(angle)))
-            angle += 2 * math.pi / 5
-            points.append((pos[0] + size * 0.5 * math.cos(angle), pos[1] + size * 0.5 * math.sin(angle)))
-        pygame.draw.polygon(screen, cursor["color"], points, 2)
 
+ARITHMETIC = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": divide}
 
-# ---------------------------
-# Interpreter: Process Tokens and Execute Commands
-# ---------------------------
-def interpret(tokens):
-    global cursor, symbols, call_stack
-    i = 0
+
+def add_const(value):
+    # Store a value in the constants pool and return its index.
+    consts.append(value)
+    return len(consts) - 1
+
+
+def slot_for(names, name):
+    # Give each distinct name used by a program or function its own slot index.
+    if name not in names:
+        names[name] = len(names)
+    return names[name]
+
+
+def fold(expr):
+    # Constant folding: replace operations whose operands are all numbers with their result.
+    if expr[0] != KIND_BIN:
+        return expr
+    left = fold(expr[2])
+    right = fold(expr[3])
+    if left[0] == KIND_CONST and right[0] == KIND_CONST:
+        return (KIND_CONST, ARITHMETIC[expr[1]](left[1], right[1]))
+    return (KIND_BIN, expr[1], left, right)
+
+
+def expr_source(expr, names, namespace):
+    # Translate a folded expression into Python source that reads variables from frame slots.
+    kind = expr[0]
+    if kind == KIND_CONST:
+        if math.isfinite(expr[1]):
+            return repr(expr[1])
+        # inf/nan have no literal form, so pass them in by name.
+        name = "k" + str(len(namespace))
+        namespace[name] = expr[1]
+        return name
+    if kind == KIND_VAR:
+        return "values[" + str(slot_for(names, expr[1])) + "]"
+    op = expr[1]
+    left = expr_source(expr[2], names, namespace)
+    right = expr_source(expr[3], names, namespace)
+    if op == "/":
+        return "divide(" + left + ", " + right + ")"
+    # Parenthesize operands only where Python would otherwise group them differently, so long
+    # chains like a + b + c stay flat instead of nesting one level per operator.
+    if needs_parens(expr[2], op, False):
+        left = "(" + left + ")"
+    if needs_parens(expr[3], op, True):
+        right = "(" + right + ")"
+    return left + " " + op + " " + right
+
+
+def needs_parens(operand, op, on_right):
+    # Leaves and divide() calls are atoms. An infix operand needs parentheses when it binds more
+    # loosely than op, or as tightly on the right, since floating-point arithmetic is not associative.
+    if operand[0] != KIND_BIN or operand[1] == "/":
+        return False
+    if on_right:
+        return PRECEDENCE[operand[1]] <= PRECEDENCE[op]
+    return PRECEDENCE[operand[1]] < PRECEDENCE[op]
+
+
+def closure_expr(expr, names):
+    # Build an evaluator from nested closures; used when Python cannot compile the generated source.
+    kind = expr[0]
+    if kind == KIND_CONST:
+        value = expr[1]
+        return lambda values: value
+    if kind == KIND_VAR:
+        slot = slot_for(names, expr[1])
+        return lambda values: values[slot]
+    fn = ARITHMETIC[expr[1]]
+    left = closure_expr(expr[2], names)
+    right = closure_expr(expr[3], names)
+    return lambda values: fn(left(values), right(values))
+
+
+def compile_expr(expr, names):
+    # Fold an expression and compile it to a Python function of the current frame's slot values,
+    # so evaluating it runs as native Python bytecode rather than through an interpreter loop.
+    expr = fold(expr)
+    namespace = {"divide": divide}
+    source = "lambda values: " + expr_source(expr, names, namespace)
+    try:
+        return eval(compile(source, "<sketchscript>", "eval"), namespace)
+    except (SyntaxError, RecursionError, MemoryError):
+        # Deeply nested divisions exceed the limits of Python's parser.
+        return closure_expr(expr, names)
+
+
+def compile_condition(tokens, i, names):
+    # Compile an IF/WHILE condition and return its constants-pool index.
+    cond, i = parse_condition(tokens, i)
+    if i >= len(tokens) or tokens[i] != "{":
+        raise Exception("Expected { after condition")
+    compiled = {"left": compile_expr(cond["left"], names), "fn": cond["fn"],
+                "right": compile_expr(cond["right"], names)}
+    return add_const(compiled), i + 1
+
+
+def compile_block(tokens, i, code, names):
+    # Compile statements until the closing brace of the current block (or the end of tokens).
     while i < len(tokens):
         token = tokens[i]
+        if token == "}":
+            return i + 1
+
         # Variable assignment: SET var = <expression>
         if token == "SET":
             var = tokens[i + 1]
             if tokens[i + 2] != "=":
                 raise Exception("Expected '=' in SET statement")
-            expr, new_i = parse_expression(tokens, i + 3, stop_tokens=COMMAND_KEYWORDS)
-            symbols[var] = eval_expr(expr)
-            i = new_i
+            expr, i = parse_expression(tokens, i + 3, stop_tokens=COMMAND_KEYWORDS)
+            code.append(("STORE_LOCAL", slot_for(names, var), add_const(compile_expr(expr, names))))
 
         # Function definition: DEFINE func ( param1 , param2 ) { ... }
         elif token == "DEFINE":
@@ -318,11 +368,24 @@ def interpret(tokens):
                 j += 1
             if tokens[j + 1] != "{":
                 raise Exception("Expected { to start function body")
-            body_start = j + 2
-            body_end = find_block_end(tokens, body_start)
-            func_body = tokens[body_start:body_end - 1]  # Exclude closing brace
-            symbols[func_name] = {"params": params, "body": func_body}
-            i = body_end
+            # The body is compiled once here and reused by every CALL. Parameters take the first slots.
+            func_names = {}
+            param_slots = [slot_for(func_names, param) for param in params]
+            func_code = []
+            i = compile_block(tokens, j + 2, func_code, func_names)
+            func_code = fuse_move_turn(func_code)
+            func = {"params": params, "param_slots": param_slots, "names": func_names, "compiled": func_code,
+                    "free": [(slot, name) for name, slot in func_names.items() if slot not in param_slots]}
+            # A self-call as the body's last instruction is a tail call: turn it into a jump back
+            # to the start of the body that reuses the current frame.
+            last = func_code[-1] if func_code else None
+            if (last is not None and last[0] == "CALL" and last[1] == func_names.get(func_name)
+                    and len(consts[last[3]]) == len(params)):
+                func_code[-1] = ("TAIL_CALL",) + last[1:] + (add_const(func),)
+            # Only bodies that never call out can be memoized: a callee would resolve its free names
+            # through frames that are not part of the memo key.
+            func["memoize"] = all(ins[0] not in ("CALL", "COLOR_RANDOM") for ins in func_code)
+            code.append(("DEFINE", slot_for(names, func_name), add_const(func)))
 
         # Function call: CALL func ( arg1 , arg2 )
         elif token == "CALL":
@@ -331,109 +394,492 @@ def interpret(tokens):
                 raise Exception("Expected ( in function call")
             j = i + 3
             args = []
-            arg_tokens = []
-            while tokens[j] != ")":
+            # Arguments are parsed straight from the token list; no sub-lists are copied out.
+            while j < len(tokens) and tokens[j] != ")":
                 if tokens[j] == ",":
-                    if arg_tokens:
-                        args.append(parse_full_expression(arg_tokens))
-                        arg_tokens = []
-                else:
-                    arg_tokens.append(tokens[j])
-                j += 1
-            if arg_tokens:
-                args.append(parse_full_expression(arg_tokens))
-            func = symbols.get(func_name)
-            if func is None:
-                raise Exception("Undefined function: " + func_name)
-            if len(args) != len(func["params"]):
-                raise Exception("Function " + func_name + " expects " + str(len(func["params"])) +
-                                " arguments, got " + str(len(args)))
-            # Set up the local scope for the function call
-            local_scope = {}
-            for param, arg_expr in zip(func["params"], args):
-                local_scope[param] = eval_expr(arg_expr)
-            call_stack.append(symbols.copy())
-            symbols.update(local_scope)
-            interpret(func["body"])
-            # Restore previous state after function execution
-            symbols.clear()
-            symbols.update(call_stack.pop())
+                    j += 1
+                    continue
+                expr, j = parse_expression_until(tokens, j, {",", ")"})
+                args.append(compile_expr(expr, names))
+            code.append(("CALL", slot_for(names, func_name), add_const(func_name), add_const(args)))
             i = j + 1
 
         # Conditional execution: IF <condition> { ... }
         elif token == "IF":
-            cond, new_i = parse_condition(tokens, i + 1)
-            if tokens[new_i] != "{":
-                raise Exception("Expected { after IF condition")
-            block_start = new_i + 1
-            block_end = find_block_end(tokens, block_start)
-            if eval_condition(cond):
-                interpret(tokens[block_start:block_end - 1])
-            i = block_end
+            cond, i = compile_condition(tokens, i + 1, names)
+            jump = len(code)
+            code.append(None)
+            i = compile_block(tokens, i, code, names)
+            code[jump] = ("JMP_IF_FALSE", cond, len(code))
 
         # Loop execution: WHILE <condition> { ... }
         elif token == "WHILE":
-            cond, new_i = parse_condition(tokens, i + 1)
-            if tokens[new_i] != "{":
-                raise Exception("Expected { after WHILE condition")
-            block_start = new_i + 1
-            block_end = find_block_end(tokens, block_start)
-            while eval_condition(cond):
-                interpret(tokens[block_start:block_end - 1])
-            i = block_end
+            cond, i = compile_condition(tokens, i + 1, names)
+            loop_start = len(code)
+            code.append(None)
+            i = compile_block(tokens, i, code, names)
+            code.append(("JMP", loop_start))
+            code[loop_start] = ("JMP_IF_FALSE", cond, len(code))
 
         # Cursor movement: MOVE <expression> Forward|Backward
         elif token == "MOVE":
-            expr, new_i = parse_expression(tokens, i + 1, stop_tokens={"Forward", "Backward"})
-            distance = eval_expr(expr)
-            direction = tokens[new_i]
-            move_cursor(distance, direction)
-            i = new_i + 1
+            expr, i = parse_expression(tokens, i + 1, stop_tokens={"Forward", "Backward"})
+            if i >= len(tokens):
+                raise Exception("Expected Forward or Backward in MOVE")
+            # Any other direction word still evaluates the distance but leaves the cursor in place.
+            code.append((MOVE_OPCODES.get(tokens[i], "MOVE_NONE"), add_const(compile_expr(expr, names))))
+            i += 1
 
         # Cursor rotation: TURN <expression> Right|Left
         elif token == "TURN":
-            expr, new_i = parse_expression(tokens, i + 1, stop_tokens={"Right", "Left"})
-            angle_val = eval_expr(expr)
-            direction = tokens[new_i]
-            if direction == "Right":
-                cursor["angle"] += angle_val
-            elif direction == "Left":
-                cursor["angle"] -= angle_val
-            i = new_i + 1
+            expr, i = parse_expression(tokens, i + 1, stop_tokens={"Right", "Left"})
+            if i >= len(tokens):
+                raise Exception("Expected Right or Left in TURN")
+            # Any other direction word still evaluates the angle but does not turn.
+            code.append((TURN_OPCODES.get(tokens[i], "TURN_NONE"), add_const(compile_expr(expr, names))))
+            i += 1
 
         # Drawing a shape: DRAW <shape> <expression> [AT <x> , <y>]
         elif token == "DRAW":
             shape = tokens[i + 1]
-            expr, new_i = parse_expression(tokens, i + 2,
-                                           stop_tokens={"AT", "SET", "DEFINE", "CALL", "IF", "WHILE", "MOVE", "TURN",
-                                                        "DRAW", "COLOR", "}"})
-            size = eval_expr(expr)
-            i = new_i
-            x_val = None
-            y_val = None
+            expr, i = parse_expression(tokens, i + 2,
+                                       stop_tokens={"AT", "SET", "DEFINE", "CALL", "IF", "WHILE", "MOVE", "TURN",
+                                                    "DRAW", "COLOR", "}"})
+            size = add_const(compile_expr(expr, names))
+            position = None
             # Optional position specifier for drawing the shape
             if i < len(tokens) and tokens[i] == "AT":
                 i += 1
                 x_expr, i = parse_expression(tokens, i, stop_tokens={","})
-                x_val = eval_expr(x_expr)
                 if tokens[i] == ",":
                     i += 1
                 y_expr, i = parse_expression(tokens, i, stop_tokens=COMMAND_KEYWORDS)
-                y_val = eval_expr(y_expr)
-            draw_shape(shape, size, x_val, y_val)
+                position = add_const((compile_expr(x_expr, names), compile_expr(y_expr, names)))
+            # Unknown shapes draw nothing, so no instruction is emitted for them.
+            if shape in SHAPE_OPCODES:
+                code.append((SHAPE_OPCODES[shape], size, position))
 
         # Color setting: COLOR <color>
         elif token == "COLOR":
             color = tokens[i + 1]
             if color == "Random":
-                cursor["color"] = random.choice(list(COLORS.values()))
+                code.append(("COLOR_RANDOM",))
             else:
-                cursor["color"] = COLORS.get(color, (255, 255, 255))
+                code.append(("COLOR", add_const(COLORS.get(color, DEFAULT_COLOR))))
             i += 2
 
         # If token doesn't match any known command, move to next token.
         else:
             i += 1
+    return i
+
+
+# Operands of the fused MOVE_TURN instruction: the MOVE direction and the sign of the TURN angle.
+MOVE_DIRECTIONS = {"MOVE_FWD": "Forward", "MOVE_BWD": "Backward"}
+TURN_SIGNS = {"TURN_RIGHT": 1, "TURN_LEFT": -1}
+
+
+def fuse_move_turn(code):
+    # Peephole pass: rewrite each MOVE directly followed by a TURN into one MOVE_TURN instruction.
+    # A TURN that is itself a jump target must stay separate, and jump targets are remapped afterwards.
+    targets = set()
+    for ins in code:
+        if ins[0] == "JMP":
+            targets.add(ins[1])
+        elif ins[0] == "JMP_IF_FALSE":
+            targets.add(ins[2])
+    fused = []
+    new_index = []
+    ip = 0
+    while ip < len(code):
+        ins = code[ip]
+        new_index.append(len(fused))
+        if (ins[0] in MOVE_DIRECTIONS and ip + 1 < len(code) and code[ip + 1][0] in TURN_SIGNS
+                and ip + 1 not in targets):
+            turn = code[ip + 1]
+            fused.append(("MOVE_TURN", ins[1], MOVE_DIRECTIONS[ins[0]], turn[1], TURN_SIGNS[turn[0]]))
+            new_index.append(len(fused) - 1)
+            ip += 2
+            continue
+        fused.append(ins)
+        ip += 1
+    if len(fused) == len(code):
+        return code
+    new_index.append(len(fused))
+    for ip, ins in enumerate(fused):
+        if ins[0] == "JMP":
+            fused[ip] = ("JMP", new_index[ins[1]])
+        elif ins[0] == "JMP_IF_FALSE":
+            fused[ip] = ("JMP_IF_FALSE", ins[1], new_index[ins[2]])
+    return fused
+
+
+def compile_program(tokens):
+    # Compile a whole program. Stray closing braces at the top level are skipped.
+    names = {}
+    code = []
+    i = 0
+    while i < len(tokens):
+        i = compile_block(tokens, i, code, names)
+    return {"names": names, "compiled": fuse_move_turn(code)}
+
+
+# ---------------------------
+# Drawing Functions
+# ---------------------------
+# Unit-circle offsets of a 5-point star's outer and inner vertices, computed once at startup.
+STAR_UNIT = []
+for _i in range(5):
+    _angle = _i * 4 * math.pi / 5
+    STAR_UNIT.append((math.cos(_angle), math.sin(_angle)))
+    _angle += 2 * math.pi / 5
+    STAR_UNIT.append((0.5 * math.cos(_angle), 0.5 * math.sin(_angle)))
+
+
+def move_cursor(distance, direction="Forward"):
+    if direction == "Backward":
+        distance = -distance
+    for record in recordings:
+        record["kinds"].append(EFFECT_MOVE)
+        record["numbers"].append(distance)
+        if len(record["kinds"]) > MEMO_RECORD_LIMIT:
+            stop_recording(record)
+    # Save the current cursor position.
+    old_x, old_y = cursor["x"], cursor["y"]
+    # Update the cursor's position along its cached direction vector.
+    cursor["x"] += distance * cursor["cos"]
+    cursor["y"] += distance * cursor["sin"]
+    # Extend the current stroke; a color change starts a new one.
+    points = stroke["points"]
+    if not points or stroke["color"] != cursor["color"]:
+        flush_stroke()
+        stroke["color"] = cursor["color"]
+        points.append((old_x, old_y))
+    points.append((cursor["x"], cursor["y"]))
+    if len(points) >= STROKE_LIMIT:
+        flush_stroke()
+        points.append((cursor["x"], cursor["y"]))
+
+
+def flush_stroke():
+    # Draw the pending stroke as one polyline and start a new, empty one.
+    points = stroke["points"]
+    if len(points) > 1:
+        pygame.draw.lines(screen, stroke["color"], False, points, 2)
+    points.clear()
+
+
+def turn_cursor(degrees):
+    # Rotate the cursor and recompute the direction vector used by move_cursor.
+    for record in recordings:
+        record["kinds"].append(EFFECT_TURN)
+        record["numbers"].append(degrees)
+        if len(record["kinds"]) > MEMO_RECORD_LIMIT:
+            stop_recording(record)
+    # Keep the heading in [0, 360) so calls that start on the same heading share memo records.
+    cursor["angle"] = (cursor["angle"] + degrees) % 360
+    angle_rad = math.radians(cursor["angle"])
+    cursor["cos"] = math.cos(angle_rad)
+    cursor["sin"] = math.sin(angle_rad)
+
+
+def set_color(color):
+    # Change the color used for subsequent lines and shapes.
+    for record in recordings:
+        record["kinds"].append(EFFECT_COLOR)
+        record["refs"].append(color)
+        if len(record["kinds"]) > MEMO_RECORD_LIMIT:
+            stop_recording(record)
+    cursor["color"] = color
+
+
+def draw_shape(shape, size, x=None, y=None):
+    for record in recordings:
+        record["kinds"].append(EFFECT_SHAPE)
+        record["refs"].append((shape, size, x, y))
+        if len(record["kinds"]) > MEMO_RECORD_LIMIT:
+            stop_recording(record)
+    # Finish pending lines first so the shape is drawn on top of them.
+    flush_stroke()
+    # Determine the position to draw the shape. Use provided coordinates if available.
+    pos = (int(x) if x is not None else int(cursor["x"]),
+           int(y) if y is not None else int(cursor["y"]))
+    if shape == "Circle":
+        pygame.draw.circle(screen, cursor["color"], pos, int(size), 2)
+    elif shape == "Square":
+        pygame.draw.rect(screen, cursor["color"],
+                         (pos[0] - int(size) // 2, pos[1] - int(size) // 2, int(size), int(size)), 2)
+    elif shape == "Star":
+        # Scale the precomputed star vertices to the requested size
+        points = [(pos[0] + cx * size, pos[1] + cy * size) for cx, cy in STAR_UNIT]
+        pygame.draw.polygon(screen, cursor["color"], points, 2)
+
+
+# ---------------------------
+# Call Memoization: Record and Replay Function Drawings
+# ---------------------------
+# A call whose body makes no calls (other than looping through its own tail call) can only read its
+# own frame, so its effects depend only on its slot values at entry and on the cursor's heading and color.
+# While a call runs, every cursor operation it performs is logged; a later call with the same entry
+# state replays that log instead of executing the body again. Moves are relative, so the replay
+# draws the same figure wherever the cursor currently is.
+# A record stores one byte per operation in 'kinds'; move distances and turn angles are packed
+# as doubles in 'numbers', and shape arguments and colors are kept in 'refs'.
+EFFECT_MOVE, EFFECT_TURN, EFFECT_SHAPE, EFFECT_COLOR = range(4)
+
+
+def memo_key(func, values):
+    # Functions are stored as dicts, which are keyed by identity.
+    return (id(func), cursor["angle"], cursor["color"],
+            tuple(id(value) if isinstance(value, dict) else value for value in values))
+
+
+def replay(record):
+    # Re-apply a recorded sequence of cursor operations.
+    numbers = iter(record["numbers"])
+    refs = iter(record["refs"])
+    for kind in record["kinds"]:
+        if kind == EFFECT_MOVE:
+            move_cursor(next(numbers))
+        elif kind == EFFECT_TURN:
+            turn_cursor(next(numbers))
+        elif kind == EFFECT_SHAPE:
+            draw_shape(*next(refs))
+        else:
+            set_color(next(refs))
+
+
+def stop_recording(record):
+    # Abandon a record that grew past MEMO_RECORD_LIMIT; the rest of the call runs unlogged.
+    # 'recordings' holds at most one record, so removing it ends the caller's loop over the list.
+    record["overflow"] = True
+    recordings.remove(record)
+
+
+def run_recorded(func, values, key):
+    # Run a call while logging its cursor operations, and cache the log unless the call was impure.
+    record = {"kinds": bytearray(), "numbers": array.array("d"), "refs": [], "pure": True, "overflow": False}
+    recordings.append(record)
+    run(func["compiled"], values)
+    if record["overflow"]:
+        # Too long to be worth replaying; the function stays memoizable for shorter calls.
+        return
+    recordings.pop()
+    if not record["pure"]:
+        # COLOR Random ran or another function was called, so the same entry state may draw
+        # differently next time.
+        func["memoize"] = False
+        return
+    ops = len(record["kinds"]) + 1
+    if memo_size["ops"] + ops > MEMO_LIMIT:
+        memo_cache.clear()
+        memo_size["ops"] = 0
+    memo_cache[key] = record
+    memo_size["ops"] += ops
+
+
+# ---------------------------
+# Virtual Machine: Execute Compiled Bytecode
+# ---------------------------
+def lookup(name):
+    # Resolve a name from the innermost frame outwards; undefined variables evaluate to 0.
+    for names, values in reversed(scopes):
+        slot = names.get(name)
+        if slot is not None:
+            return values[slot]
+    return 0
+
+
+def eval_condition(cond, values):
+    # Evaluate a condition by comparing two evaluated expressions.
+    return cond["fn"](cond["left"](values), cond["right"](values))
+
+
+# Each handler receives the instruction, the instruction pointer and the slot values of the
+# current frame, and returns the index of the next instruction to execute.
+def op_store_local(ins, ip, values):
+    # Assignments always target the current frame, so a function's writes vanish when it returns.
+    values[ins[1]] = consts[ins[2]](values)
+    return ip + 1
+
+
+def op_jmp(ins, ip, values):
+    return ins[1]
+
+
+def op_jmp_if_false(ins, ip, values):
+    return ip + 1 if eval_condition(consts[ins[1]], values) else ins[2]
+
+
+def op_define(ins, ip, values):
+    values[ins[1]] = consts[ins[2]]
+    return ip + 1
+
+
+def op_call(ins, ip, values):
+    func = values[ins[1]]
+    func_name = consts[ins[2]]
+    arg_codes = consts[ins[3]]
+    if not isinstance(func, dict):
+        raise Exception("Undefined function: " + func_name)
+    if len(arg_codes) != len(func["params"]):
+        raise Exception("Function " + func_name + " expects " + str(len(func["params"])) +
+                        " arguments, got " + str(len(arg_codes)))
+    # Every other name the body uses starts out with the value visible at the call site.
+    # Nothing outside the callee can change while it runs, so copying them in once is enough.
+    callee = [0] * len(func["names"])
+    for slot, name in func["free"]:
+        callee[slot] = lookup(name)
+    for slot, code in zip(func["param_slots"], arg_codes):
+        callee[slot] = code(values)
+    # Calls made while recording are not memoized themselves; they belong to the running record.
+    if recordings or not func["memoize"]:
+        scopes.append((func["names"], callee))
+        run(func["compiled"], callee)
+        scopes.pop()
+        return ip + 1
+    key = memo_key(func, callee)
+    record = memo_cache.get(key)
+    if record is not None:
+        replay(record)
+        return ip + 1
+    scopes.append((func["names"], callee))
+    run_recorded(func, callee, key)
+    scopes.pop()
+    return ip + 1
+
+
+def op_tail_call(ins, ip, values):
+    # The slot may have been rebound to a different function; then this is an ordinary call.
+    func = consts[ins[4]]
+    if values[ins[1]] is not func:
+        # That function reads names from frames outside the memo key, so the record cannot be reused.
+        for record in recordings:
+            record["pure"] = False
+        return op_call(ins, ip, values)
+    # A fresh call would copy in exactly the values this frame already holds, so only the
+    # parameters change. Evaluate every argument before overwriting any of them.
+    args = [code(values) for code in consts[ins[3]]]
+    for slot, arg in zip(func["param_slots"], args):
+        values[slot] = arg
+    return 0
+
+
+def op_move_fwd(ins, ip, values):
+    move_cursor(consts[ins[1]](values), "Forward")
+    return ip + 1
+
+
+def op_move_bwd(ins, ip, values):
+    move_cursor(consts[ins[1]](values), "Backward")
+    return ip + 1
+
+
+def op_move_none(ins, ip, values):
+    # An unknown direction moves by nothing, which still marks a dot at the cursor.
+    consts[ins[1]](values)
+    move_cursor(0.0)
+    return ip + 1
+
+
+def op_turn_right(ins, ip, values):
+    turn_cursor(consts[ins[1]](values))
+    return ip + 1
+
+
+def op_turn_left(ins, ip, values):
+    turn_cursor(-consts[ins[1]](values))
+    return ip + 1
+
+
+def op_turn_none(ins, ip, values):
+    consts[ins[1]](values)
+    return ip + 1
+
+
+def op_move_turn(ins, ip, values):
+    # Fused MOVE + TURN: both cursor updates in a single dispatch.
+    move_cursor(consts[ins[1]](values), ins[2])
+    turn_cursor(ins[4] * consts[ins[3]](values))
+    return ip + 1
+
+
+def draw_instruction(shape, ins, values):
+    # Evaluate the size and optional AT position of a DRAW instruction, then draw the shape.
+    x_val = y_val = None
+    if ins[2] is not None:
+        x_code, y_code = consts[ins[2]]
+        x_val = x_code(values)
+        y_val = y_code(values)
+    draw_shape(shape, consts[ins[1]](values), x_val, y_val)
+
+
+def op_draw_circle(ins, ip, values):
+    draw_instruction("Circle", ins, values)
+    return ip + 1
+
+
+def op_draw_square(ins, ip, values):
+    draw_instruction("Square", ins, values)
+    return ip + 1
+
+
+def op_draw_star(ins, ip, values):
+    draw_instruction("Star", ins, values)
+    return ip + 1
+
+
+def op_color(ins, ip, values):
+    set_color(consts[ins[1]])
+    return ip + 1
+
+
+def op_color_random(ins, ip, values):
+    for record in recordings:
+        record["pure"] = False
+    cursor["color"] = random.choice(COLOR_VALUES)
+    return ip + 1
+
+
+# Dispatch table mapping every opcode to its handler.
+HANDLERS = {
+    "STORE_LOCAL": op_store_local,
+    "JMP": op_jmp,
+    "JMP_IF_FALSE": op_jmp_if_false,
+    "DEFINE": op_define,
+    "CALL": op_call,
+    "TAIL_CALL": op_tail_call,
+    "MOVE_FWD": op_move_fwd,
+    "MOVE_BWD": op_move_bwd,
+    "MOVE_NONE": op_move_none,
+    "TURN_RIGHT": op_turn_right,
+    "TURN_LEFT": op_turn_left,
+    "TURN_NONE": op_turn_none,
+    "MOVE_TURN": op_move_turn,
+    "DRAW_CIRCLE": op_draw_circle,
+    "DRAW_SQUARE": op_draw_square,
+    "DRAW_STAR": op_draw_star,
+    "COLOR": op_color,
+    "COLOR_RANDOM": op_color_random,
+}
+
+
+def run(code, values):
+    # Fetch-dispatch loop: look up each opcode's handler and jump to the address it returns.
+    handlers = HANDLERS
+    ip = 0
+    end = len(code)
+    while ip < end:
+        ins = code[ip]
+        ip = handlers[ins[0]](ins, ip, values)
+
+
+def run_program(program):
+    # Run a compiled program in a fresh frame of global slots.
+    values = [0] * len(program["names"])
+    scopes.append((program["names"], values))
+    run(program["compiled"], values)
+    scopes.pop()
 
 
 # ---------------------------
@@ -443,6 +889,8 @@ STATE_SYNTAX = "syntax"  # Show syntax help/instructions
 STATE_INPUT = "input"  # Accept user input for SketchScript code
 STATE_RUNNING = "running"  # Display the interpreter's drawing output
 current_state = STATE_SYNTAX
+EDITOR_FPS = 60  # Frame rate while editing, for the blinking cursor
+IDLE_FPS = 10  # Frame rate of the static syntax and drawing screens
 
 # ---------------------------
 # Input Handling Variables
@@ -451,12 +899,43 @@ user_input = ""
 cursor_blink = 0
 use_sample = False  # If True, use the SAMPLE_CODE as input
 
+# ---------------------------
+# Editor Layout Cache
+# ---------------------------
+# Measuring and rendering text goes through SDL_ttf, so the editor's wrapped lines are rendered
+# once per edit instead of every frame. 'editor_layout' holds the text it was built from, the
+# rendered line surfaces and the x position of the blinking cursor.
+editor_layout = (None, [], 0)
+editor_prompt = font.render("Type your program (TAB for sample, ENTER to run):", True, (255, 255, 0))
+
+
+def layout_editor(text):
+    # Word-wrap the text to the window width and render every resulting line.
+    surfaces = []
+    for line in text.split("\n"):
+        words = line.split()
+        current_line = ""
+        for word in words:
+            test_line = current_line + word + " "
+            if font.size(test_line)[0] < WIDTH - 20:
+                current_line = test_line
+            else:
+                surfaces.append(font.render(current_line, True, (255, 255, 255)))
+                current_line = word + " "
+        if current_line:
+            surfaces.append(font.render(current_line, True, (255, 255, 255)))
+    return text, surfaces, font.size(text)[0] + 15
+
+
 # ---------------------------
 # Main Application Loop
 # ---------------------------
 running_main = True
+dirty = True  # When True, the next frame is redrawn and flipped to the display
 while running_main:
     for event in pygame.event.get():
+        # Any event (key press, window exposure, ...) may change what is on screen.
+        dirty = True
         # Handle quit events
         if event.type == pygame.QUIT:
             running_main = False
@@ -471,7 +950,9 @@ while running_main:
                     # Clear the screen and run the interpreter once
                     screen.fill((20, 20, 20))
                     tokens = tokenize(code)
-                    interpret(tokens)
+                    run_program(compile_program(tokens))
+                    # Draw the last pending stroke now so UI text is drawn on top of the lines.
+                    flush_stroke()
                 elif event.key == pygame.K_BACKSPACE:
                     user_input = user_input[:-1]
                 elif event.key == pygame.K_TAB:
@@ -488,58 +969,56 @@ while running_main:
                 current_state = STATE_SYNTAX
                 user_input = ""
                 use_sample = False
-                cursor = {"x": WIDTH // 2, "y": HEIGHT // 2, "angle": 0, "color": (255, 255, 255)}
-                symbols.clear()
-                call_stack.clear()
+                cursor = {"x": WIDTH // 2, "y": HEIGHT // 2, "angle": 0, "cos": 1.0, "sin": 0.0,
+                          "color": (255, 255, 255)}
+                scopes.clear()
+                memo_cache.clear()
+                memo_size["ops"] = 0
+                consts.clear()
+
+    # The blinking cursor animates the editor, so it is redrawn on every frame.
+    if current_state == STATE_INPUT:
+        dirty = True
 
     # ---------------------------
-    # UI Rendering Based on Current State
+    # UI Rendering Based on Current State (only when something changed)
     # ---------------------------
-    if current_state == STATE_SYNTAX:
-        # Clear screen and display syntax instructions.
-        screen.fill((20, 20, 20))
-        for i, line in enumerate(SYNTAX):
-            text = font.render(line, True, (255, 255, 255))
-            screen.blit(text, (10, 10 + i * 25))
-        instr = font.render("Press SPACE to start writing", True, (255, 255, 0))
-        screen.blit(instr, (10, HEIGHT - 40))
-    elif current_state == STATE_INPUT:
-        # Clear screen and display the code editor prompt.
-        screen.fill((20, 20, 20))
-        prompt = font.render("Type your program (TAB for sample, ENTER to run):", True, (255, 255, 0))
-        screen.blit(prompt, (10, 10))
-        # Render each line of user input.
-        lines = user_input.split("\n")
-        y_offset = 40
-        for line in lines:
-            words = line.split()
-            current_line = ""
-            for word in words:
-                test_line = current_line + word + " "
-                if font.size(test_line)[0] < WIDTH - 20:
-                    current_line = test_line
-                else:
-                    text = font.render(current_line, True, (255, 255, 255))
-                    screen.blit(text, (10, y_offset))
-                    y_offset += 25
-                    current_line = word + " "
-            if current_line:
-                text = font.render(current_line, True, (255, 255, 255))
+    if dirty:
+        if current_state == STATE_SYNTAX:
+            # Clear screen and display syntax instructions.
+            screen.fill((20, 20, 20))
+            for i, line in enumerate(SYNTAX):
+                text = font.render(line, True, (255, 255, 255))
+                screen.blit(text, (10, 10 + i * 25))
+            instr = font.render("Press SPACE to start writing", True, (255, 255, 0))
+            screen.blit(instr, (10, HEIGHT - 40))
+        elif current_state == STATE_INPUT:
+            # Clear screen and display the code editor prompt.
+            screen.fill((20, 20, 20))
+            screen.blit(editor_prompt, (10, 10))
+            # Rebuild the wrapped lines only when the input has changed since the last layout.
+            if editor_layout[0] != user_input:
+                editor_layout = layout_editor(user_input)
+            y_offset = 40
+            for text in editor_layout[1]:
                 screen.blit(text, (10, y_offset))
                 y_offset += 25
 
-        # Render a blinking cursor in the code editor.
-        cursor_blink = (cursor_blink + 1) % 30
-        if cursor_blink < 15:
-            cursor_pos = font.size(user_input)[0] + 15
-            pygame.draw.line(screen, (255, 255, 255), (cursor_pos, y_offset - 20), (cursor_pos, y_offset), 2)
-    elif current_state == STATE_RUNNING:
-        # Do not clear the screen in running state so that drawings persist.
-        instr = font.render("Press R to restart", True, (255, 255, 0))
-        screen.blit(instr, (10, HEIGHT - 40))
-
-    # Update the display and cap the frame rate.
-    pygame.display.flip()
-    clock.tick(60)
+            # Render a blinking cursor in the code editor.
+            cursor_blink = (cursor_blink + 1) % 30
+            if cursor_blink < 15:
+                cursor_pos = editor_layout[2]
+                pygame.draw.line(screen, (255, 255, 255), (cursor_pos, y_offset - 20), (cursor_pos, y_offset), 2)
+        elif current_state == STATE_RUNNING:
+            # Do not clear the screen in running state so that drawings persist.
+            instr = font.render("Press R to restart", True, (255, 255, 0))
+            screen.blit(instr, (10, HEIGHT - 40))
+
+        # Update the display.
+        pygame.display.flip()
+        dirty = False
+
+    # Cap the frame rate; screens without animation only need to keep polling for input.
+    clock.tick(EDITOR_FPS if current_state == STATE_INPUT else IDLE_FPS)
 
 pygame.quit()